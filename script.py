@@ -1,7 +1,16 @@
-import json
+import gzip
+import hashlib
 import os
+import random
+import signal
+import struct
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 try:
     import h3
     H3_AVAILABLE = True
@@ -16,11 +25,15 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 BATCH_SIZE = int(os.getenv('BATCH_SIZE', '1000'))
 MAX_LINGER = int(os.getenv('MAX_LINGER', '15000'))
+FLUSH_ROWS = int(os.getenv('FLUSH_ROWS', '20000'))
+FLUSH_INTERVAL = int(os.getenv('FLUSH_INTERVAL', '60'))
+MAX_BUFFERED_ROWS = int(os.getenv('MAX_BUFFERED_ROWS', '200000'))
 
 CLICKHOUSE_URL = os.getenv('CLICKHOUSE_URL')
 CLICKHOUSE_USER = os.getenv('CLICKHOUSE_USER', 'default')
 CLICKHOUSE_PASSWORD = os.getenv('CLICKHOUSE_PASSWORD', '')
 CLICKHOUSE_DB = os.getenv('CLICKHOUSE_DB', 'default')
+CLICKHOUSE_MAX_ATTEMPTS = 6
 
 required_vars = ['CLIENT_ID', 'CLIENT_SECRET', 'CLICKHOUSE_URL']
 for var in required_vars:
@@ -28,9 +41,37 @@ for var in required_vars:
         raise RuntimeError(f"Missing required environment variable: {var}")
 
 ALERT_FIELDS = ('Alerts', 'ActiveAlerts', 'ActiveAlertIds')
+# Columns that are carried as dedicated row fields rather than metrics/info.
+SKIP_FIELDS = frozenset(('DeviceType', 'UtcTimestampNs', 'DeviceId') + ALERT_FIELDS)
+
+# Column kinds produced by compile_columns.
+COLUMN_VALUE = 0
+COLUMN_H3 = 1
+
+# Compiled column metadata by schema hash; see compile_schema.
+_schema_cache = {}
+
+# One pooled session for every HTTP call so keep-alive connections are reused
+# across token refreshes, telemetry polls and ClickHouse inserts.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, pool_block=False)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+# Inserts run on a background worker so the next telemetry poll overlaps the
+# previous batch's upload. A single worker keeps batches in order.
+INSERT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# The three tables are independent, so a flush uploads them concurrently.
+TABLE_EXECUTOR = ThreadPoolExecutor(max_workers=3)
+
+# Rows accumulate here across polls and are flushed in larger batches, which
+# means fewer inserts and fewer MergeTree parts for ClickHouse to merge.
+_buffers = {'telemetry': [], 'alerts': [], 'ip_allocations': []}
+_last_flush = time.monotonic()
+_pending_insert = None
 
 def get_starlink_access_token():
-    return requests.post(
+    return SESSION.post(
         'https://api.starlink.com/auth/connect/token',
         data=
             {
@@ -44,7 +85,7 @@ def map_entry_to_record(entry, columns):
     """
     Build a record dict by zipping telemetry entry values with their column names.
     """
-    return {column: entry[idx] for idx, column in enumerate(columns) if idx < len(entry)}
+    return dict(zip(columns, entry))
 
 def clean_field_value(value):
     """
@@ -52,28 +93,59 @@ def clean_field_value(value):
     """
     if value is None:
         return None
-    if isinstance(value, list):
+    if type(value) is list:
+        # Most list fields are empty or hold a single element; skip the join.
+        count = len(value)
+        if count == 0:
+            return None
+        if count == 1:
+            item = value[0]
+            return None if item is None else str(item)
         return ';'.join(str(v) for v in value if v is not None)
     return value
 
-def extract_alert_codes(record):
+def extract_alert_codes(entry, alert_idxs):
     """
-    Return a list of alert codes from a telemetry record, if present.
+    Return a list of alert codes from a telemetry entry, if present.
+    `alert_idxs` are the positions of ALERT_FIELDS columns, in ALERT_FIELDS order.
     """
-    for field in ALERT_FIELDS:
-        if field in record:
-            val = record[field]
+    for idx in alert_idxs:
+        if idx < len(entry):
+            val = entry[idx]
             if isinstance(val, list):
                 return [str(v) for v in val if v is not None]
             if val not in (None, ''):
                 return [str(val)]
     return []
 
+def _as_str_list(record, key):
+    """
+    Return a record field as a list of strings: [] when missing, one item for
+    a scalar, and the non-None items of a list.
+    """
+    value = record.get(key)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v) for v in value if v is not None]
+    return [str(value)]
+
+def entry_value(entry, idx):
+    if idx is None or idx >= len(entry):
+        return None
+    return entry[idx]
+
 def to_float(value):
-    try:
+    if isinstance(value, (int, float)):
         return float(value)
-    except (ValueError, TypeError):
-        return None
+    # Most string fields (firmware versions, names, ...) are not numeric; check
+    # the first character so they don't each pay for a raised ValueError.
+    if isinstance(value, str) and value and value[0] in '0123456789-+.':
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
 
 def normalize_device_id(device_type_code, device_id):
     if device_type_code == 'i' and isinstance(device_id, str) and device_id.startswith("ip-"):
@@ -93,19 +165,24 @@ def h3_to_lat_lon(cell_value):
     if cell_value in (None, ''):
         return None
     try:
-        if isinstance(cell_value, int):
-            cell_str = hex(cell_value)
-        else:
-            # Accept both hex string and plain string; convert digits to int->hex for safety.
-            if isinstance(cell_value, str) and cell_value.isdigit():
-                cell_str = hex(int(cell_value))
-            else:
-                cell_str = str(cell_value)
-        lat, lon = h3.cell_to_latlng(cell_str)
-        return lat, lon
+        return _cell_to_lat_lon(cell_value)
     except Exception:
         return None
 
+@lru_cache(maxsize=4096)
+def _cell_to_lat_lon(cell_value):
+    # Terminals report the same cell poll after poll, so memoize the conversion.
+    if isinstance(cell_value, int):
+        cell_str = hex(cell_value)
+    else:
+        # Accept both hex string and plain string; convert digits to int->hex for safety.
+        if isinstance(cell_value, str) and cell_value.isdigit():
+            cell_str = hex(int(cell_value))
+        else:
+            cell_str = str(cell_value)
+    lat, lon = h3.cell_to_latlng(cell_str)
+    return lat, lon
+
 def ensure_tables():
     ddl_statements = [
         f"""
@@ -147,95 +224,296 @@ def ensure_tables():
     for ddl in ddl_statements:
         execute_clickhouse_query(ddl)
 
-def execute_clickhouse_query(query):
-    backoff = 1
-    while True:
+def post_to_clickhouse(query, description, data=None, headers=None):
+    """
+    POST a query to ClickHouse, retrying with jittered exponential backoff.
+    Raises RuntimeError after CLICKHOUSE_MAX_ATTEMPTS failed attempts so the
+    caller decides what to do instead of the poll loop stalling forever.
+    """
+    for attempt in range(CLICKHOUSE_MAX_ATTEMPTS):
         try:
-            resp = requests.post(
+            resp = SESSION.post(
                 CLICKHOUSE_URL,
                 params={'query': query},
+                data=data,
+                headers=headers,
                 auth=(CLICKHOUSE_USER, CLICKHOUSE_PASSWORD),
                 timeout=20,
             )
             if resp.status_code == 200:
                 return
             else:
-                print(f"ClickHouse query failed ({resp.status_code}): {resp.text}", flush=True)
+                print(f"{description} failed ({resp.status_code}): {resp.text}", flush=True)
         except requests.RequestException as exc:
-            print(f"ClickHouse request error: {exc}", flush=True)
-        time.sleep(backoff)
-        backoff = min(backoff * 2, 60)
+            print(f"{description} request error: {exc}", flush=True)
+        if attempt < CLICKHOUSE_MAX_ATTEMPTS - 1:
+            time.sleep(min(60, 2 ** attempt) * (0.5 + random.random()))
+    raise RuntimeError(f"{description} failed after {CLICKHOUSE_MAX_ATTEMPTS} attempts")
 
-def insert_json_rows(table, rows):
+def execute_clickhouse_query(query):
+    post_to_clickhouse(query, "ClickHouse query")
+
+# Precompiled once instead of looking the format string up on every pack().
+_UINT64 = struct.Struct('<Q')
+_FLOAT64 = struct.Struct('<d')
+
+def _write_varint(buf, value):
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def _write_string(buf, value):
+    data = value.encode('utf-8')
+    _write_varint(buf, len(data))
+    buf += data
+
+@lru_cache(maxsize=4096)
+def _encoded_string(value):
+    buf = bytearray()
+    _write_string(buf, value)
+    return bytes(buf)
+
+def _write_repeated_string(buf, value):
+    # For low-cardinality strings (map keys, device types, alert names) that
+    # repeat on every row: encode each distinct value once and copy the bytes.
+    buf += _encoded_string(value)
+
+def _write_uint64(buf, value):
+    buf += _UINT64.pack(value)
+
+def _write_string_array(buf, values):
+    _write_varint(buf, len(values))
+    for value in values:
+        _write_string(buf, value)
+
+def _write_float_map(buf, mapping):
+    _write_varint(buf, len(mapping))
+    for key, value in mapping.items():
+        buf += _encoded_string(key)
+        buf += _FLOAT64.pack(value)
+
+def _write_string_map(buf, mapping):
+    _write_varint(buf, len(mapping))
+    for key, value in mapping.items():
+        buf += _encoded_string(key)
+        _write_string(buf, value)
+
+# Column order and RowBinary writer for each table; rows from build_rows are
+# tuples in this order.
+TABLE_COLUMNS = {
+    'telemetry': (
+        ('device_type', _write_repeated_string),
+        ('device_id', _write_string),
+        ('ts_ns', _write_uint64),
+        ('metrics', _write_float_map),
+        ('info', _write_string_map),
+    ),
+    'alerts': (
+        ('device_type', _write_repeated_string),
+        ('device_id', _write_string),
+        ('ts_ns', _write_uint64),
+        ('alert_name', _write_repeated_string),
+    ),
+    'ip_allocations': (
+        ('device_id', _write_string),
+        ('ts_ns', _write_uint64),
+        ('ipv4', _write_string_array),
+        ('ipv6_ue', _write_string_array),
+        ('ipv6_cpe', _write_string_array),
+    ),
+}
+
+def encode_row_binary(table, rows):
+    """
+    Serialize row tuples for `table` in ClickHouse RowBinary format.
+    """
+    writers = [writer for _, writer in TABLE_COLUMNS[table]]
+    buf = bytearray()
+    for row in rows:
+        for writer, value in zip(writers, row):
+            writer(buf, value)
+    return bytes(buf)
+
+def insert_rows(table, rows):
     if not rows:
         return
-    query = f"INSERT INTO {CLICKHOUSE_DB}.{table} FORMAT JSONEachRow"
-    payload = "\n".join(json.dumps(row, ensure_ascii=False) for row in rows)
-    backoff = 1
-    while True:
+    column_list = ', '.join(name for name, _ in TABLE_COLUMNS[table])
+    query = f"INSERT INTO {CLICKHOUSE_DB}.{table} ({column_list}) FORMAT RowBinary"
+    # Map keys repeat on every row, so even the fastest gzip level shrinks
+    # the payload several times over; ClickHouse decompresses it natively.
+    payload = gzip.compress(encode_row_binary(table, rows), compresslevel=1)
+    post_to_clickhouse(
+        query,
+        f"Insert to {table}",
+        data=payload,
+        headers={'Content-Encoding': 'gzip'},
+    )
+
+def insert_batch(batch):
+    """
+    Insert each table's rows. Returns the rows of the tables whose insert
+    failed so they can be retried with the next flush.
+    """
+    futures = {
+        table: TABLE_EXECUTOR.submit(insert_rows, table, rows)
+        for table, rows in batch.items()
+    }
+    failed = {}
+    for table, future in futures.items():
         try:
-            resp = requests.post(
-                CLICKHOUSE_URL,
-                params={'query': query},
-                data=payload.encode('utf-8'),
-                auth=(CLICKHOUSE_USER, CLICKHOUSE_PASSWORD),
-                timeout=20,
-            )
-            if resp.status_code == 200:
-                return
-            else:
-                print(f"Insert to {table} failed ({resp.status_code}): {resp.text}", flush=True)
-        except requests.RequestException as exc:
-            print(f"Insert to {table} request error: {exc}", flush=True)
-        time.sleep(backoff)
-        backoff = min(backoff * 2, 60)
+            future.result()
+        except RuntimeError as exc:
+            print(exc, flush=True)
+            failed[table] = batch[table]
+    return failed
+
+def requeue_rows(failed):
+    """
+    Put rows from a failed flush back in front of the buffers. If ClickHouse
+    stays down, the oldest rows beyond MAX_BUFFERED_ROWS are dropped so memory
+    stays bounded.
+    """
+    for table, rows in failed.items():
+        buffered = rows + _buffers[table]
+        dropped = len(buffered) - MAX_BUFFERED_ROWS
+        if dropped > 0:
+            print(f"Dropping {dropped} buffered {table} rows; buffer limit reached", flush=True)
+            buffered = buffered[dropped:]
+        _buffers[table] = buffered
+
+def buffer_rows(telemetry_rows, alert_rows, ip_rows):
+    _buffers['telemetry'].extend(telemetry_rows)
+    _buffers['alerts'].extend(alert_rows)
+    _buffers['ip_allocations'].extend(ip_rows)
+
+def flush_due():
+    if not any(_buffers.values()):
+        return False
+    if any(len(rows) >= FLUSH_ROWS for rows in _buffers.values()):
+        return True
+    return time.monotonic() - _last_flush >= FLUSH_INTERVAL
+
+def flush_buffers():
+    """
+    Hand the buffered rows to the insert worker and start new buffers.
+    Only one flush is ever in flight: wait for the previous one first and
+    requeue anything it failed to insert.
+    """
+    global _last_flush, _pending_insert
+    if _pending_insert is not None:
+        requeue_rows(_pending_insert.result())
+        _pending_insert = None
+    batch = {table: rows for table, rows in _buffers.items()}
+    for table in _buffers:
+        _buffers[table] = []
+    _last_flush = time.monotonic()
+    _pending_insert = INSERT_EXECUTOR.submit(insert_batch, batch)
+
+def flush_on_exit():
+    """
+    Wait for any in-flight flush and write out whatever is still buffered.
+    """
+    global _pending_insert
+    if _pending_insert is not None:
+        requeue_rows(_pending_insert.result())
+        _pending_insert = None
+    for table, rows in insert_batch(_buffers).items():
+        print(f"Discarding {len(rows)} {table} rows that could not be written before exit", flush=True)
+
+def compile_columns(columns):
+    """
+    Precompute positions for a device type's columns so build_rows can read
+    entries by index without building a record dict or comparing names.
+    Returns `(device_id_idx, ts_idx, alert_idxs, value_columns)` where
+    `value_columns` holds `(idx, name, kind)` for the columns that feed
+    metrics/info.
+    """
+    positions = {name: idx for idx, name in enumerate(columns)}
+    alert_idxs = [positions[field] for field in ALERT_FIELDS if field in positions]
+    value_columns = []
+    for idx, name in enumerate(columns):
+        if name in SKIP_FIELDS:
+            continue
+        kind = COLUMN_H3 if name.lower() == 'h3cellid' else COLUMN_VALUE
+        value_columns.append((idx, name, kind))
+    return positions.get('DeviceId'), positions.get('UtcTimestampNs'), alert_idxs, value_columns
+
+def compile_schema(column_names_by_type):
+    """
+    Compile the columns of every device type in a response. The schema is
+    nearly always identical from poll to poll, so results are cached by a
+    hash of the column names.
+    """
+    key = hashlib.blake2b(orjson.dumps(column_names_by_type), digest_size=8).digest()
+    compiled_by_type = _schema_cache.get(key)
+    if compiled_by_type is None:
+        if len(_schema_cache) >= 16:
+            _schema_cache.clear()
+        compiled_by_type = {
+            code: compile_columns(columns)
+            for code, columns in column_names_by_type.items()
+            if columns
+        }
+        _schema_cache[key] = compiled_by_type
+    return compiled_by_type
 
 def build_rows(telemetry, column_names_by_type, device_type_names, alert_names_by_device):
     telemetry_rows = []
     alert_rows = []
     ip_rows = []
+    compiled_by_type = compile_schema(column_names_by_type)
 
     for entry in telemetry:
         if not entry or entry[0] == 'r':
             continue
 
         device_type_code = entry[0]
-        columns = column_names_by_type.get(device_type_code)
-        if not columns:
+        compiled = compiled_by_type.get(device_type_code)
+        if compiled is None:
             continue
 
-        record = map_entry_to_record(entry, columns)
-        device_id_raw = record.get('DeviceId')
+        device_id_idx, ts_idx, alert_idxs, value_columns = compiled
+
+        device_id_raw = entry_value(entry, device_id_idx)
         device_id = normalize_device_id(device_type_code, device_id_raw)
-        ts_ns = record.get('UtcTimestampNs')
+        ts_ns = entry_value(entry, ts_idx)
         if device_id is None or ts_ns is None:
             continue
+        device_id = str(device_id)
+        ts_ns = int(ts_ns)
 
         if device_type_code == 'i':
-            ipv4 = record.get('Ipv4') if isinstance(record.get('Ipv4'), list) else ([] if record.get('Ipv4') is None else [record.get('Ipv4')])
-            ipv6_ue = record.get('Ipv6Ue') if isinstance(record.get('Ipv6Ue'), list) else ([] if record.get('Ipv6Ue') is None else [record.get('Ipv6Ue')])
-            ipv6_cpe = record.get('Ipv6Cpe') if isinstance(record.get('Ipv6Cpe'), list) else ([] if record.get('Ipv6Cpe') is None else [record.get('Ipv6Cpe')])
+            record = map_entry_to_record(entry, column_names_by_type[device_type_code])
             ip_rows.append(
-                {
-                    "device_id": device_id,
-                    "ts_ns": int(ts_ns),
-                    "ipv4": [str(v) for v in ipv4],
-                    "ipv6_ue": [str(v) for v in ipv6_ue],
-                    "ipv6_cpe": [str(v) for v in ipv6_cpe],
-                }
+                (
+                    device_id,
+                    ts_ns,
+                    _as_str_list(record, 'Ipv4'),
+                    _as_str_list(record, 'Ipv6Ue'),
+                    _as_str_list(record, 'Ipv6Cpe'),
+                )
             )
             continue
 
         metrics = {}
         info = {}
         lat_lon = None
-        for key, value in record.items():
-            if key in {'DeviceType', 'UtcTimestampNs', 'DeviceId'} or key in ALERT_FIELDS:
+        entry_len = len(entry)
+        for idx, key, kind in value_columns:
+            if idx >= entry_len:
+                break
+            value = entry[idx]
+            # Plain numbers are the bulk of the values: store them directly,
+            # bypassing clean_field_value/to_float (bools take the slow path).
+            value_type = type(value)
+            if (value_type is float or value_type is int) and kind == COLUMN_VALUE:
+                metrics[key] = float(value)
                 continue
             cleaned_value = clean_field_value(value)
             if cleaned_value is None or cleaned_value == '':
                 continue
-            if key.lower() == 'h3cellid':
+            if kind == COLUMN_H3:
                 lat_lon = h3_to_lat_lon(value)
                 # Do not store the raw H3 cell in metrics/info; only derived lat/lon.
                 continue
@@ -249,33 +527,61 @@ def build_rows(telemetry, column_names_by_type, device_type_names, alert_names_b
             info['latitude'] = str(lat_lon[0])
             info['longitude'] = str(lat_lon[1])
 
+        # Resolved once per record and shared by the telemetry and alert rows.
+        device_type = device_type_names.get(device_type_code, device_type_code)
         telemetry_rows.append(
-            {
-                "device_type": device_type_names.get(device_type_code, device_type_code),
-                "device_id": device_id,
-                "ts_ns": int(ts_ns),
-                "metrics": metrics,
-                "info": info,
-            }
+            (
+                device_type,
+                device_id,
+                ts_ns,
+                metrics,
+                info,
+            )
         )
 
         if device_type_code == 'u':
-            alert_codes = extract_alert_codes(record)
+            alert_codes = extract_alert_codes(entry, alert_idxs)
             if alert_codes:
                 alert_name_map = alert_names_by_device.get(device_type_code, {})
                 for code in alert_codes:
                     alert_name = alert_name_map.get(code, code)
                     alert_rows.append(
-                        {
-                            "device_type": device_type_names.get(device_type_code, device_type_code),
-                            "device_id": device_id,
-                            "ts_ns": int(ts_ns),
-                            "alert_name": alert_name,
-                        }
+                        (
+                            device_type,
+                            device_id,
+                            ts_ns,
+                            str(alert_name),
+                        )
                     )
 
     return telemetry_rows, alert_rows, ip_rows
 
+def build_rows_from_response(body):
+    """
+    Decode a telemetry stream response body and build insert rows from it.
+    Returns None when the response carries no values. The decoded JSON is
+    several times the size of the body and is freed as soon as this returns.
+    """
+    # orjson parses the multi-MB telemetry body several times faster than stdlib json.
+    response_json = orjson.loads(body)
+
+    data_section = response_json.get('data', {})
+    telemetry = data_section.get('values', [])
+
+    if len(telemetry) == 0:
+        return None
+
+    column_names_by_type = data_section.get('columnNamesByDeviceType', {})
+    device_type_names = response_json.get('metadata', {}).get('enums', {}).get('DeviceType', {})
+    alert_names_by_device = response_json.get('metadata', {}).get('enums', {}).get('AlertsByDeviceType', {})
+
+    return build_rows(
+        telemetry,
+        column_names_by_type,
+        device_type_names,
+        alert_names_by_device
+    )
+
 def poll_stream():
     """
     Constantly polls telemetry API. Expect to get a response about every 15 seconds.
@@ -285,8 +591,11 @@ def poll_stream():
     ensure_tables()
 
     while True:
+        if flush_due():
+            flush_buffers()
+
         start_time = time.time()
-        response = requests.post(
+        response = SESSION.post(
             'https://starlink.com/api/public/v2/telemetry/stream',
             json=
                 {
@@ -306,32 +615,26 @@ def poll_stream():
             access_token = get_starlink_access_token()
             continue
 
-        response_json = response.json()
-
-        data_section = response_json.get('data', {})
-        telemetry = data_section.get('values', [])
-
-        if len(telemetry) == 0:
+        rows = build_rows_from_response(response.content)
+        # Release the raw body now instead of holding it through the sleep
+        # and the next poll's download.
+        del response
+        if rows is None:
             continue
 
-        column_names_by_type = data_section.get('columnNamesByDeviceType', {})
-        device_type_names = response_json.get('metadata', {}).get('enums', {}).get('DeviceType', {})
-        alert_names_by_device = response_json.get('metadata', {}).get('enums', {}).get('AlertsByDeviceType', {})
-
-        telemetry_rows, alert_rows, ip_rows = build_rows(
-            telemetry,
-            column_names_by_type,
-            device_type_names,
-            alert_names_by_device
-        )
-
-        insert_json_rows('telemetry', telemetry_rows)
-        insert_json_rows('alerts', alert_rows)
-        insert_json_rows('ip_allocations', ip_rows)
+        telemetry_rows, alert_rows, ip_rows = rows
+        buffer_rows(telemetry_rows, alert_rows, ip_rows)
 
         elapsed_time = time.time() - start_time
         sleep_duration = max(0, 15 - elapsed_time)
         time.sleep(sleep_duration)
 
 if __name__ == '__main__':
-    poll_stream()
+    # Turn SIGTERM (docker stop) into a normal exit so buffered rows are flushed.
+    # The flush runs in `finally` rather than atexit: the insert executors no
+    # longer accept work once interpreter shutdown has started.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        poll_stream()
+    finally:
+        flush_on_exit()